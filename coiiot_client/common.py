@@ -1,12 +1,13 @@
-from typing import Dict, Any, NamedTuple, List, Union, Optional, Type
+from typing import Dict, Any, NamedTuple, List, Union, Optional, Type, Tuple
 from datetime import datetime
-import json
 import enum
+import sys
 
 from . utils import (
     dt_to_ts,
-    get_value_or_error,
-    get_collection_value,
+    json_dumps,
+    missing_key_error,
+    null_key_error,
 )
 
 
@@ -18,6 +19,13 @@ class ParseError(APIError):
     pass
 
 
+def _intern_name(value: Any, name: str, exception: Type[Exception]) -> str:
+    try:
+        return sys.intern(value)
+    except TypeError:
+        raise exception(f'Key "name" must be a string in {name}') from None
+
+
 class Location(NamedTuple):
 
     lat: float
@@ -32,6 +40,9 @@ class Location(NamedTuple):
 
 ValueT = Union[int, str, bool, float, Location, datetime]
 
+# value types serialized as is, checked before the isinstance fallback
+_PLAIN_VALUE_TYPES = frozenset((int, str, bool, float))
+
 
 class EventTag(NamedTuple):
 
@@ -61,12 +72,49 @@ class EventMessage(NamedTuple):
     tags: List[EventTag]
 
     def to_dict(self) -> Dict[str, Any]:
+        # inlined EventTag.to_dict with local bindings, messages may
+        # carry big batches of tags
+        location_t, datetime_t, to_ts = Location, datetime, dt_to_ts
+
+        # batches are usually stamped with one shared datetime object,
+        # so its conversion is reused while the timestamp stays the same
+        last_dt, last_ts = None, None
+
+        tags = []
+        append = tags.append
+        for tag in self.tags:
+            value = tag.value
+            value_t = type(value)
+            if value_t is location_t:
+                value = {"lat": value.lat, "lng": value.lng}
+
+            elif value_t is datetime_t:
+                value = to_ts(value)
+
+            elif value_t not in _PLAIN_VALUE_TYPES:
+                # subclasses (e.g. pandas.Timestamp) miss the exact type checks
+                if isinstance(value, location_t):
+                    value = {"lat": value.lat, "lng": value.lng}
+
+                elif isinstance(value, datetime_t):
+                    value = to_ts(value)
+
+            timestamp = tag.timestamp
+            if timestamp is not last_dt:
+                last_dt, last_ts = timestamp, to_ts(timestamp)
+
+            append({
+                "id": tag.id,
+                "value": value,
+                "timestamp": last_ts,
+            })
+
         return {
-            "tags": [tag.to_dict() for tag in self.tags],
+            "tags": tags,
         }
 
-    def dumps(self) -> str:
-        return json.dumps(self.to_dict())
+    def dumps(self) -> bytes:
+        return json_dumps(self.to_dict())
 
 
 class TagType(NamedTuple):
@@ -76,9 +124,18 @@ class TagType(NamedTuple):
 
     @staticmethod
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'TagType':
+        try:
+            type_id = raw["id"]
+            name = raw["name"]
+        except KeyError as e:
+            raise missing_key_error(e, "tag type input", exception) from None
+
+        if type_id is None or name is None:
+            raise null_key_error(raw, ("id", "name"), "tag type input", exception)
+
         return TagType(
-            id=get_value_or_error(raw, "id", "tag type input", exception),
-            name=get_value_or_error(raw, "name", "tag type input", exception),
+            id=type_id,
+            name=_intern_name(name, "tag type input", exception),
         )
 
 
@@ -90,9 +147,18 @@ class Driver(NamedTuple):
 
     @staticmethod
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'Driver':
+        try:
+            driver_id = raw["id"]
+            name = raw["name"]
+        except KeyError as e:
+            raise missing_key_error(e, "driver input", exception) from None
+
+        if driver_id is None or name is None:
+            raise null_key_error(raw, ("id", "name"), "driver input", exception)
+
         return Driver(
-            id=get_value_or_error(raw, "id", "driver input", exception),
-            name=get_value_or_error(raw, "name", "driver input", exception),
+            id=driver_id,
+            name=name,
             protocol=raw.get("protocol"),
         )
 
@@ -109,24 +175,50 @@ class Tag(NamedTuple):
 
     @staticmethod
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'Tag':
-        children = dict()
-        for raw_tag in get_collection_value(raw, "children", list):
-            tag = Tag.from_dict(raw_tag, exception)
-            children[tag.name] = tag
+        # fields are indexed directly, configs may hold deep tag trees
+        try:
+            tag_id = raw["id"]
+            name = raw["name"]
+            raw_type = raw["type"]
+            properties = raw["properties"]
+        except KeyError as e:
+            raise missing_key_error(e, "tag input", exception) from None
+
+        if tag_id is None or name is None or raw_type is None or properties is None:
+            raise null_key_error(raw, ("id", "name", "type", "properties"), "tag input", exception)
+
+        from_dict = Tag.from_dict
+        children = {
+            tag.name: tag
+            for tag in (from_dict(raw_tag, exception) for raw_tag in raw.get("children") or ())
+        }
 
         return Tag(
-            id=get_value_or_error(raw, "id", "tag input", exception),
-            name=get_value_or_error(raw, "name", "tag input", exception),
-            type=TagType.from_dict(
-                get_value_or_error(raw, "type", "tag input", exception),
-                exception,
-            ),
-            properties=get_value_or_error(raw, "properties", "tag input", exception),
-            attrs=get_collection_value(raw, "attrs", dict),
+            id=tag_id,
+            # the same tag names repeat across devices, interning keeps
+            # one copy of each and speeds up children lookups by name
+            name=_intern_name(name, "tag input", exception),
+            type=TagType.from_dict(raw_type, exception),
+            properties=properties,
+            attrs=raw.get("attrs") or {},
             children=children,
-            driver_config=get_collection_value(raw, "driver_config", dict),
+            driver_config=raw.get("driver_config") or {},
         )
 
+    def flat_index(self) -> Dict[Tuple[str, ...], 'Tag']:
+        # maps every path of child names (root is the empty path) to its tag,
+        # so deep tags are found with a single dict lookup
+        index = {(): self}
+        stack = [((), self)]
+        while stack:
+            path, tag = stack.pop()
+            for name, child in tag.children.items():
+                child_path = path + (name,)
+                index[child_path] = child
+                stack.append((child_path, child))
+
+        return index
+
 
 class Device(NamedTuple):
 
@@ -139,15 +231,23 @@ class Device(NamedTuple):
 
     @staticmethod
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'Device':
+        try:
+            device_id = raw["id"]
+            name = raw["name"]
+            raw_tag = raw["tag"]
+            raw_driver = raw["driver"]
+        except KeyError as e:
+            raise missing_key_error(e, "device input", exception) from None
+
+        if device_id is None or name is None or raw_tag is None or raw_driver is None:
+            raise null_key_error(raw, ("id", "name", "tag", "driver"), "device input", exception)
+
         return Device(
-            id=get_value_or_error(raw, "id", "device input", exception),
-            name=get_value_or_error(raw, "name", "device input", exception),
-            tag=Tag.from_dict(get_value_or_error(raw, "tag", "device input", exception), exception),
-            driver_config=get_collection_value(raw, "driver_config", dict),
-            driver=Driver.from_dict(
-                get_value_or_error(raw, "driver", "device input", exception),
-                exception,
-            ),
+            id=device_id,
+            name=name,
+            tag=Tag.from_dict(raw_tag, exception),
+            driver_config=raw.get("driver_config") or {},
+            driver=Driver.from_dict(raw_driver, exception),
             config_id=raw.get("config_id"),
         )
 
@@ -162,17 +262,25 @@ class Agent(NamedTuple):
 
     @staticmethod
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'Agent':
+        try:
+            agent_id = raw["id"]
+            name = raw["name"]
+            raw_tag = raw["tag"]
+            raw_devices = raw["devices"]
+        except KeyError as e:
+            raise missing_key_error(e, "agent input", exception) from None
+
+        if agent_id is None or name is None or raw_tag is None or raw_devices is None:
+            raise null_key_error(raw, ("id", "name", "tag", "devices"), "agent input", exception)
+
         return Agent(
-            id=get_value_or_error(raw, "id", "agent input", exception),
+            id=agent_id,
             config_id=raw.get("config_id"),
-            name=get_value_or_error(raw, "name", "agent input", exception),
-            tag=Tag.from_dict(
-                get_value_or_error(raw, "tag", "agent input", exception),
-                exception,
-            ),
+            name=name,
+            tag=Tag.from_dict(raw_tag, exception),
             devices=[
-                Device.from_dict(raw, exception)
-                for raw in get_value_or_error(raw, "devices", "agent input", exception)
+                Device.from_dict(raw_device, exception)
+                for raw_device in raw_devices
             ],
         )
 
@@ -197,6 +305,13 @@ class LogRecord(NamedTuple):
             "message": self.message,
         }
 
+    @staticmethod
+    def to_list(records: List['LogRecord']) -> List[Dict[str, Any]]:
+        return [
+            {"level": int(level), "message": message}
+            for level, message in records
+        ]
+
 
 @enum.unique
 class CommandStatus(enum.Enum):
@@ -210,22 +325,27 @@ class CommandStatus(enum.Enum):
 
     @staticmethod
     def from_string(value: str, exception: Type[Exception]) -> 'CommandStatus':
-        try:
-            return CommandStatus(value)
-        except ValueError as e:
-            raise exception(f"parse command_status failed, value '{value}' is unknown") from e
+        # plain dict lookup, no ValueError raised and caught on the happy path
+        status = CommandStatus._value2member_map_.get(value)
+        if status is None:
+            raise exception(f"parse command_status failed, value '{value}' is unknown")
+
+        return status
 
 
 class Auth:
 
+    __slots__ = ("_token", "_client_id", "_agent_id", "_login")
+
     def __init__(self, client_id: int, agent_id: int, agent_token: str):
         self._token = agent_token
         self._client_id = client_id
         self._agent_id = agent_id
-    
+        self._login = f"{client_id}_{agent_id}"
+
     @property
     def login(self) -> str:
-        return f"{self._client_id}_{self._agent_id}"
+        return self._login
 
     @property
     def passw(self) -> str:
@@ -1,15 +1,16 @@
-import base64
 from datetime import datetime
 from typing import Dict, Any, NamedTuple, List, Union, Optional, Type
 
 import aiohttp
 import asyncio
 
-import simplejson as json
-
 from . utils import (
     dt_to_ts,
     dt_from_ts,
+    json_dumps,
+    json_loads,
+    materialize,
+    LazyJSONParser,
     get_value_or_error,
     get_collection_value,
 )
@@ -34,6 +35,9 @@ from . common import (
 )
 
 
+_PARSER = LazyJSONParser()
+
+
 class ImproperlyConfigurationError(ParseError):
     pass
 
@@ -58,6 +62,16 @@ class InternalServerError(HTTPError):
     pass
 
 
+_STATUS_EXCEPTIONS: Dict[int, Type[HTTPError]] = {
+    400: BadParamsError,
+    401: UnauthorizedError,
+    404: NotFoundError,
+    500: InternalServerError,
+}
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
 class Config(NamedTuple):
 
     agent: Agent
@@ -72,8 +86,8 @@ class Config(NamedTuple):
         )
 
     @staticmethod
-    def loads(raw: str, exception: Type[Exception]) -> 'Config':
-        return Config.from_dict(json.loads(raw), exception)
+    def loads(raw: Union[str, bytes], exception: Type[Exception]) -> 'Config':
+        return Config.from_dict(json_loads(raw), exception)
 
 
 class CommandTag(NamedTuple):
@@ -85,7 +99,7 @@ class CommandTag(NamedTuple):
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'CommandTag':
         return CommandTag(
             id=get_value_or_error(raw, "tag_id", "command tag input", exception),
-            value=get_value_or_error(raw, "value", "command tag input", exception),
+            value=materialize(get_value_or_error(raw, "value", "command tag input", exception)),
         )
 
 
@@ -154,8 +168,8 @@ class AgentDevicesCommands(NamedTuple):
         )
 
     @staticmethod
-    def loads(raw: str, exception: Type[Exception]) -> 'AgentDevicesCommands':
-        return AgentDevicesCommands.from_dict(json.loads(raw), exception)
+    def loads(raw: Union[str, bytes], exception: Type[Exception]) -> 'AgentDevicesCommands':
+        return AgentDevicesCommands.from_dict(_PARSER.parse(raw), exception)
 
 
 class VersionedDeviceConfig(NamedTuple):
@@ -182,8 +196,8 @@ class VersionedDeviceConfig(NamedTuple):
         )
 
     @staticmethod
-    def loads(raw: str, exception: Type[Exception]) -> 'VersionedDeviceConfig':
-        return VersionedDeviceConfig.from_dict(json.loads(raw), exception)
+    def loads(raw: Union[str, bytes], exception: Type[Exception]) -> 'VersionedDeviceConfig':
+        return VersionedDeviceConfig.from_dict(json_loads(raw), exception)
 
 
 class CommandStatusMessage(NamedTuple):
@@ -193,54 +207,122 @@ class CommandStatusMessage(NamedTuple):
     reason: Optional[str] = None
 
     def to_dict(self) -> Dict[str, Any]:
+        # unset optional fields are omitted rather than sent as null
         result = {
             "status": self.status.value,
-            "reason": self.reason,
-            "timestamp": None,
         }
 
         if self.timestamp is not None:
             result["timestamp"] = dt_to_ts(self.timestamp)
-        
+
+        if self.reason is not None:
+            result["reason"] = self.reason
+
         return result
 
 
 class Client(object):
 
-    def __init__(self, base_url: str, auth: Auth, timeout=20, loop=asyncio.get_event_loop()):
+    def __init__(self, base_url: str, auth: Auth, timeout=20,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 batch_size: int = 100, flush_interval: float = 0.5,
+                 pool_limit: int = 10, keepalive_timeout: float = 120):
         self._base_url = base_url
         self._loop = loop
         self._auth = auth
         self._timeout = timeout
-
-    async def _do_request(self, method, url, **kwargs) -> Dict[str, Any]:
-        async with aiohttp.ClientSession(loop=self._loop) as session:
-            async with getattr(session, method)(
-                url,
-                timeout=self._timeout,
-                auth=aiohttp.BasicAuth(
-                    login=self._auth.login,
-                    password=self._auth.passw,
+        self._pool_limit = pool_limit
+        self._keepalive_timeout = keepalive_timeout
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._event_buf: List[EventTag] = []
+        self._log_buf: List[LogRecord] = []
+        self._flush_wakeup = None
+        self._flush_task = None
+        self._closing = False
+        self._basic_auth = aiohttp.BasicAuth(
+            login=auth.login,
+            password=auth.passw,
+        )
+        self._session = None
+        self._config_cache = None
+
+    async def _ensure_session(self) -> aiohttp.ClientSession:
+        # one long-lived session keeps connections (and TLS sessions) alive
+        # between requests instead of reconnecting on every call
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=self._basic_auth,
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+                # agent polls are sporadic, so idle connections are kept longer
+                # than aiohttp's 15s default. enable_cleanup_closed drops
+                # connections that TLS servers close without shutdown.
+                connector=aiohttp.TCPConnector(
+                    limit=self._pool_limit,
+                    limit_per_host=self._pool_limit,
+                    keepalive_timeout=self._keepalive_timeout,
+                    enable_cleanup_closed=True,
                 ),
-                **kwargs,
-            ) as resp:
-                response = await resp.text()
-                if resp.status == 200:
-                    return {"status": resp.status, "text": response}
-
-                if resp.status == 400:
-                    raise BadParamsError(response)
-
-                if resp.status == 401:
-                    raise UnauthorizedError(response)
-
-                if resp.status == 404:
-                    raise NotFoundError(response)
-
-                if resp.status == 500:
-                    raise InternalServerError(response)    
-
-                raise HTTPError(f"'{url}' returns unexpected status code '{resp.status}' with body '{response}' ")
+            )
+
+        return self._session
+
+    async def __aenter__(self) -> 'Client':
+        await self._ensure_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        task, self._flush_task = self._flush_task, None
+        try:
+            if task is not None:
+                # the task finishes its current request and exits,
+                # cancelling it would drop the batch being sent
+                self._closing = True
+                self._flush_wakeup.set()
+                try:
+                    await task
+                finally:
+                    self._closing = False
+                    await self.flush()
+
+            else:
+                await self.flush()
+
+        finally:
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+
+    async def _do_request(self, method, url, read_body: bool = True, payload: Any = None, **kwargs) -> Dict[str, Any]:
+        if payload is not None:
+            # serialize with json_dumps, aiohttp's json= uses stdlib json
+            kwargs["data"] = json_dumps(payload)
+            kwargs["headers"] = _JSON_HEADERS
+
+        session = await self._ensure_session()
+        async with getattr(session, method)(url, **kwargs) as resp:
+            if resp.status == 200:
+                if not read_body:
+                    # the body is drained without buffering it, the connection
+                    # goes back to the pool only after the body is consumed
+                    async for _ in resp.content.iter_any():
+                        pass
+
+                    return {"status": resp.status, "data": None}
+
+                # raw bytes go straight to the JSON parser, no need to decode them
+                return {"status": resp.status, "data": await resp.read()}
+
+            response = await resp.text()
+
+            exc = _STATUS_EXCEPTIONS.get(resp.status)
+            if exc is not None:
+                raise exc(response)
+
+            raise HTTPError(f"'{url}' returns unexpected status code '{resp.status}' with body '{response}' ")
 
     async def get_config(self, version: Union[str, None] = None) -> Config:
         params = {}
@@ -251,14 +333,24 @@ class Client(object):
                                         f'{ self._base_url }/v1/agents/config',
                                         params=params,
                                         )
-        
-        return Config.loads(resp['text'], ImproperlyConfigurationError)
+
+        # config rarely changes between polls, reuse the parsed tree
+        # while the server returns the same document
+        cached = self._config_cache
+        if cached is not None and cached[0] == resp['data']:
+            return cached[1]
+
+        config = Config.loads(resp['data'], ImproperlyConfigurationError)
+        self._config_cache = (resp['data'], config)
+
+        return config
 
     async def send_agent_command_status(self, command_id: str, status: CommandStatusMessage):
         await self._do_request(
             "patch",
             f'{self._base_url}/v1/agents/{self._auth.agent_id}/commands/{command_id}/status',
-            json=status.to_dict(),
+            payload=status.to_dict(),
+            read_body=False,
         )
 
     async def get_commands(self) -> AgentDevicesCommands:
@@ -267,7 +359,7 @@ class Client(object):
             f'{self._base_url}/v1/commands',
         )
 
-        return AgentDevicesCommands.loads(resp['text'], ParseError)
+        return AgentDevicesCommands.loads(resp['data'], ParseError)
 
     async def get_device_versioned_config(self, version_id: int) -> VersionedDeviceConfig:    
  
@@ -276,23 +368,85 @@ class Client(object):
             f'{self._base_url}/v1/devices/config/{version_id}',
         )
 
-        return VersionedDeviceConfig.loads(resp['text'], ParseError)
+        return VersionedDeviceConfig.loads(resp['data'], ParseError)
 
     async def send_device_command_status(self, device_id: int, command_id: str, status: CommandStatusMessage):    
         await self._do_request(
             "patch",
             f'{self._base_url}/v1/devices/{device_id}/commands/{command_id}/status',
-            json=status.to_dict(),
+            payload=status.to_dict(),
+            read_body=False,
         )
 
     async def send_event(self, msg: EventMessage):
         await self._do_request("post",
                                  f'{ self._base_url }/v1/events',
-                                 json=msg.to_dict(),
+                                 payload=msg.to_dict(),
+                                 read_body=False,
                                 )
 
     async def send_logs(self, records: List[LogRecord]):
         await self._do_request("post",
                                  f'{ self._base_url }/v1/logs',
-                                 json=[rec.to_dict() for rec in records],
+                                 payload=LogRecord.to_list(records),
+                                 read_body=False,
                                 )
+
+    # Buffered tags and log records are sent in a single request every
+    # `flush_interval` seconds or as soon as `batch_size` items are pending.
+    # Call `flush` or `close` to send the rest.
+
+    def send_event_nowait(self, tag: EventTag):
+        self._ensure_flush_task()
+        self._event_buf.append(tag)
+        if len(self._event_buf) >= self._batch_size:
+            self._flush_wakeup.set()
+
+    def send_log_nowait(self, record: LogRecord):
+        self._ensure_flush_task()
+        self._log_buf.append(record)
+        if len(self._log_buf) >= self._batch_size:
+            self._flush_wakeup.set()
+
+    async def flush(self):
+        # swap buffers before awaiting, so tags buffered meanwhile go
+        # to the next batch
+        events, self._event_buf = self._event_buf, []
+        logs, self._log_buf = self._log_buf, []
+
+        try:
+            if events:
+                await self.send_event(EventMessage(tags=events))
+                events = []
+
+            if logs:
+                await self.send_logs(logs)
+                logs = []
+
+        finally:
+            # an unsent batch goes back in front of the items buffered
+            # meanwhile, so the next flush retries it
+            self._event_buf[:0] = events
+            self._log_buf[:0] = logs
+
+    def _ensure_flush_task(self):
+        if self._flush_task is None:
+            self._flush_wakeup = asyncio.Event()
+            self._flush_task = asyncio.ensure_future(self._flush_loop(), loop=self._loop)
+
+        elif self._flush_task.done():
+            # re-raise the error which stopped background flushing before
+            # the item is buffered, so retrying the call doesn't duplicate it.
+            # The next call starts flushing again.
+            task, self._flush_task = self._flush_task, None
+            task.result()
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._flush_wakeup.clear()
+            await self.flush()
@@ -1,16 +1,19 @@
-from typing import List, NamedTuple, Union, Dict, Any, AsyncIterator, Optional, Type
+from typing import List, NamedTuple, Union, Dict, Any, AsyncIterator, Optional, Type, Tuple
 from datetime import datetime
+from urllib.parse import urlsplit
+from contextlib import AsyncExitStack
 import uuid
 import asyncio
 
-import simplejson as json
-from hbmqtt.client import MQTTClient as HBClient
-from hbmqtt.mqtt.constants import QOS_1
+import aiomqtt
 
 
 from . utils import (
     dt_to_ts,
     dt_from_ts,
+    json_dumps,
+    materialize,
+    LazyJSONParser,
     get_value_or_error,
     trim_prefix,
 )
@@ -35,6 +38,37 @@ from . common import (
 )
 
 
+_PARSER = LazyJSONParser()
+
+EVENT_TOPIC = "iot/event/fmt/json"
+LOG_TOPIC = "iot/log/fmt/json"
+
+QOS_0 = 0
+QOS_1 = 1
+
+# the flusher publishes up to STATUS_WEIGHT queued command statuses
+# for every EVENT_WEIGHT event/log batches, so neither channel starves
+STATUS_WEIGHT = 3
+EVENT_WEIGHT = 1
+
+
+def _drain(queue: asyncio.Queue, limit: int) -> list:
+    items = []
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+
+    return items
+
+
+def _requeue(queue: asyncio.Queue, items: list):
+    # puts items back in front of the ones queued meanwhile
+    pending = _drain(queue, queue.qsize())
+    for item in items:
+        queue.put_nowait(item)
+    for item in pending:
+        queue.put_nowait(item)
+
+
 class ImproperlyCommandFormatError(ParseError):
     pass
 
@@ -47,6 +81,10 @@ class SubscriptionError(MQTTError):
     pass
 
 
+class ClientNotRunningError(MQTTError):
+    pass
+
+
 class CommandTag(NamedTuple):
 
     id: int
@@ -56,7 +94,7 @@ class CommandTag(NamedTuple):
     def from_dict(raw: Dict[str, Any], exception: Type[Exception]) -> 'CommandTag':
         return CommandTag(
             id=get_value_or_error(raw, "id", "command tag input", exception),
-            value=get_value_or_error(raw, "value", "command tag input", exception),
+            value=materialize(get_value_or_error(raw, "value", "command tag input", exception)),
         )
 
 
@@ -116,8 +154,8 @@ class CommandMessage(NamedTuple):
         )
 
     @staticmethod
-    def loads(raw: str, exception: Type[Exception]) -> 'CommandMessage':
-        return CommandMessage.from_dict(json.loads(raw), exception)
+    def loads(raw: Union[str, bytes], exception: Type[Exception]) -> 'CommandMessage':
+        return CommandMessage.from_dict(_PARSER.parse(raw), exception)
 
 
 class CommandStatusMessage(NamedTuple):
@@ -135,68 +173,236 @@ class CommandStatusMessage(NamedTuple):
             "timestamp": dt_to_ts(self.timestamp),
         }
 
-    def dumps(self) -> str:
-        return json.dumps(self.to_dict())
+    def dumps(self) -> bytes:
+        return json_dumps(self.to_dict())
 
 
 class Client(object):
 
-    def __init__(self, broker_uri: str, auth: Auth, loop=asyncio.get_event_loop()):
-        self._loop = loop
-        base_uri = trim_prefix(broker_uri, "mqtt://")
-        self._broker_uri = f"mqtt://{auth.login}:{auth.passw}@{base_uri}"
-        self._client = HBClient(
-            str(uuid.uuid4()),
-            loop=self._loop,
-            config={
-                "auto_reconnect": False,
-            }
-        )
+    def __init__(self, broker_uri: str, auth: Auth, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 keepalive: int = 60, batch_size: int = 100, flush_interval: float = 0.5):
+        # loop is accepted for backward compatibility and ignored,
+        # the client runs on the current loop
+        broker = urlsplit("mqtt://" + trim_prefix(broker_uri, "mqtt://"))
+        self._hostname = broker.hostname
+        self._port = broker.port or 1883
+        self._keepalive = keepalive
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._client = None
+        self._exit_stack = None
+        self._status_q = None
+        self._event_q = None
+        self._log_q = None
+        self._flush_wakeup = None
+        self._flush_lock = None
+        self._flusher = None
+        self._closing = False
         self._auth = auth
+        self._agent_cmd_topic = f"iot/cmd/agent/{auth.agent_id}/fmt/json"
+        self._agent_status_topic = f"iot/cmd/agent/{auth.agent_id}/status/fmt/json"
+        self._device_status_topics: Dict[int, str] = {}
 
-    async def run(self):
-        await self._client.connect(uri=self._broker_uri)
-        ret_code = await self._client.subscribe([
-            (f"iot/cmd/agent/{self._auth.agent_id}/fmt/json", QOS_1)
-        ])
+    def _device_status_topic(self, device_id: int) -> str:
+        topic = self._device_status_topics.get(device_id)
+        if topic is None:
+            topic = f"iot/cmd/device/{device_id}/status/fmt/json"
+            self._device_status_topics[device_id] = topic
 
-        # Return code for subscription errors is 0x80. See details here:
-        # https://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html#_Toc398718068
-        if ret_code == 0x80:
-            raise SubscriptionError
+        return topic
+
+    async def run(self):
+        # aiomqtt binds to the running loop, so the client is created here.
+        # The connection is closed right away if the subscription fails.
+        async with AsyncExitStack() as stack:
+            client = await stack.enter_async_context(aiomqtt.Client(
+                self._hostname,
+                self._port,
+                username=self._auth.login,
+                password=self._auth.passw,
+                identifier=str(uuid.uuid4()),
+                keepalive=self._keepalive,
+            ))
+
+            granted = await client.subscribe(
+                self._agent_cmd_topic,
+                qos=QOS_1,
+            )
+
+            # Return code for subscription errors is 0x80. See details here:
+            # https://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html#_Toc398718068
+            if 0x80 in granted:
+                raise SubscriptionError
+
+            self._client = client
+            self._exit_stack = stack.pop_all()
+
+        self._status_q = asyncio.Queue()
+        self._event_q = asyncio.Queue()
+        self._log_q = asyncio.Queue()
+        self._flush_wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._flusher = asyncio.ensure_future(self._flush_loop())
 
     async def close(self):
-        await self._client.disconnect()
+        flusher, self._flusher = self._flusher, None
+        try:
+            if flusher is not None:
+                # the flusher finishes its current publish and exits,
+                # cancelling it could lose items already taken off the queues
+                self._closing = True
+                self._flush_wakeup.set()
+                try:
+                    await flusher
+                finally:
+                    await self.flush()
+
+        finally:
+            self._status_q = self._event_q = self._log_q = None
+            self._client = None
+            exit_stack, self._exit_stack = self._exit_stack, None
+            if exit_stack is not None:
+                await exit_stack.aclose()
+
+    # Queued tags and log records are published in a single message every
+    # `flush_interval` seconds or as soon as `batch_size` items are pending.
+    # Call `flush` or `close` to publish the rest.
+
+    def send_event_nowait(self, tag: EventTag):
+        self._enqueue(self._event_q, tag)
+
+    def send_log_nowait(self, record: LogRecord):
+        self._enqueue(self._log_q, record)
+
+    # Queued statuses are published as soon as possible, but interleaved
+    # with telemetry according to STATUS_WEIGHT and EVENT_WEIGHT.
+
+    def send_agent_command_status_nowait(self, msg: CommandStatusMessage, qos: int = QOS_1):
+        self._enqueue(self._status_q, (self._agent_status_topic, msg.dumps(), qos))
+        self._flush_wakeup.set()
+
+    def send_device_command_status_nowait(self, device_id: int, msg: CommandStatusMessage, qos: int = QOS_1):
+        self._enqueue(self._status_q, (self._device_status_topic(device_id), msg.dumps(), qos))
+        self._flush_wakeup.set()
+
+    async def flush(self):
+        if self._status_q is None:
+            raise ClientNotRunningError("client is not running, call run() first")
+
+        # a single flush at a time keeps the weighted order
+        async with self._flush_lock:
+            # only items queued before the flush started are published,
+            # so producers can't keep it running
+            statuses = self._status_q.qsize()
+            tags = self._event_q.qsize()
+            records = self._log_q.qsize()
+
+            while statuses or tags or records:
+                count = min(STATUS_WEIGHT, statuses)
+                for _ in range(count):
+                    await self._publish_status()
+                statuses -= count
+
+                for _ in range(EVENT_WEIGHT):
+                    if not (tags or records):
+                        break
+
+                    sent_tags, sent_records = await self._publish_telemetry(tags, records)
+                    tags -= sent_tags
+                    records -= sent_records
+
+    async def _publish_status(self):
+        status = self._status_q.get_nowait()
+        topic, payload, qos = status
+        try:
+            await self._client.publish(topic, payload, qos=qos)
+        except BaseException:
+            _requeue(self._status_q, [status])
+            raise
+
+    async def _publish_telemetry(self, max_tags: int, max_records: int) -> Tuple[int, int]:
+        # items of a failed publish go back to their queue, so the
+        # next flush retries them
+        tags = _drain(self._event_q, min(max_tags, self._batch_size))
+        if tags:
+            try:
+                await self.send_event(EventMessage(tags=tags))
+            except BaseException:
+                _requeue(self._event_q, tags)
+                raise
+
+        records = _drain(self._log_q, min(max_records, self._batch_size))
+        if records:
+            try:
+                await self.send_logs(records)
+            except BaseException:
+                _requeue(self._log_q, records)
+                raise
+
+        return len(tags), len(records)
+
+    def _enqueue(self, queue: Optional[asyncio.Queue], item: Any):
+        if queue is None:
+            raise ClientNotRunningError("client is not running, call run() first")
+
+        flusher = self._flusher
+        if flusher is not None and flusher.done():
+            # re-raise the error which stopped background publishing before
+            # taking the item, so retrying the call doesn't duplicate it.
+            # The restarted flusher retries the items of the failed publish.
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+            flusher.result()
+
+        queue.put_nowait(item)
+        if queue.qsize() >= self._batch_size:
+            self._flush_wakeup.set()
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._flush_wakeup.clear()
+            await self.flush()
 
     async def send_event(self, msg: EventMessage):
         await self._client.publish(
-            "iot/event/fmt/json",
-            msg.dumps().encode("utf8"),
+            EVENT_TOPIC,
+            msg.dumps(),
             qos=QOS_1
         )
 
-    async def send_agent_command_status(self, msg: CommandStatusMessage):
+    async def send_agent_command_status(self, msg: CommandStatusMessage, qos: int = QOS_1):
         await self._client.publish(
-            f"iot/cmd/agent/{self._auth.agent_id}/status/fmt/json",
-            msg.dumps().encode("utf8"),
-            qos=QOS_1
+            self._agent_status_topic,
+            msg.dumps(),
+            qos=qos
         )
     
-    async def send_device_command_status(self, device_id: int, msg: CommandStatusMessage):
+    async def send_device_command_status(self, device_id: int, msg: CommandStatusMessage, qos: int = QOS_1):
         await self._client.publish(
-            f"iot/cmd/device/{device_id}/status/fmt/json",
-            msg.dumps().encode("utf8"),
-            qos=QOS_1
+            self._device_status_topic(device_id),
+            msg.dumps(),
+            qos=qos
         )
 
     async def send_logs(self, records: List[LogRecord]):
         await self._client.publish(
-            "iot/log/fmt/json",
-            json.dumps(records).encode("utf8"),
+            LOG_TOPIC,
+            json_dumps(LogRecord.to_list(records)),
             qos=QOS_1
         )
 
+    async def publish_many(self, topic: str, payloads: List[bytes], qos: int = QOS_1):
+        # publishes run concurrently over the same connection
+        await asyncio.gather(*[
+            self._client.publish(topic, payload, qos=qos)
+            for payload in payloads
+        ])
+
     async def incoming_commands(self) -> AsyncIterator[CommandMessage]:
-        while True:
-            message = await self._client.deliver_message()
-            yield CommandMessage.loads(message.data.decode("utf8"), ImproperlyCommandFormatError)
+        async for message in self._client.messages:
+            yield CommandMessage.loads(message.payload, ImproperlyCommandFormatError)
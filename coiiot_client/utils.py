@@ -1,6 +1,63 @@
-import json
-from typing import Dict, Any, Type, Optional, Callable
+from typing import Dict, Any, Type, Callable, Union, Tuple, Coroutine, AsyncIterator
+from contextlib import asynccontextmanager
 from datetime import datetime
+import asyncio
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+
+except ImportError:
+    import json
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf8")
+
+    json_loads = json.loads
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+class LazyJSONParser:
+    """
+    Reusable JSON parser for incoming payloads. With pysimdjson installed
+    documents are parsed lazily, so only the keys actually read by
+    ``from_dict`` are converted to Python objects. Otherwise it falls back
+    to ``json_loads``.
+    """
+
+    __slots__ = ("_parser",)
+
+    def __init__(self):
+        self._parser = simdjson.Parser() if simdjson is not None else None
+
+    def parse(self, raw: Union[str, bytes]) -> Any:
+        if self._parser is None:
+            return json_loads(raw)
+
+        try:
+            return self._parser.parse(raw)
+        except RuntimeError:
+            # previous document is still referenced (e.g. by a traceback),
+            # so the parser buffer can't be reused
+            self._parser = simdjson.Parser()
+            return self._parser.parse(raw)
+
+
+def materialize(value: Any) -> Any:
+    if simdjson is not None:
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+
+    return value
 
 
 def dt_from_ts(ts: int) -> datetime:
@@ -20,6 +77,15 @@ def get_value_or_error(collection: Dict[str, Any], key: str, name: str = "collec
     return value
 
 
+def missing_key_error(err: KeyError, name: str = "collection", exception: Type[Exception] = KeyError) -> Exception:
+    return exception(f'Key "{err.args[0]}" missing in {name}')
+
+
+def null_key_error(collection: Dict[str, Any], keys: Tuple[str, ...], name: str = "collection", exception: Type[Exception] = KeyError) -> Exception:
+    key = next(key for key in keys if collection[key] is None)
+    return exception(f'Key "{key}" missing in {name}')
+
+
 def get_collection_value(collection: Dict[str, Any], key: str, factory: Callable[[], Any]) -> Any:
     value = collection.get(key)
     if value is not None:
@@ -32,3 +98,27 @@ def trim_prefix(s, prefix) -> str:
         return s[len(prefix):]
     
     return s
+
+
+def _report_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        task.get_loop().call_exception_handler({
+            "message": "Background task failed",
+            "exception": task.exception(),
+            "task": task,
+        })
+
+
+@asynccontextmanager
+async def run_in_background(coro: Coroutine) -> AsyncIterator[asyncio.Task]:
+    # Runs `coro` in a task while the block runs and cancels it when the block
+    # exits. A failure of the task is passed to the loop's exception handler
+    # and does not interrupt the block.
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(_report_task_error)
+    try:
+        yield task
+
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
@@ -1,24 +1,53 @@
 import asyncio
-import aiojobs
 import random
 import argparse
 from datetime import datetime
 
 import coiiot_client.http as http
+from coiiot_client.utils import run_in_background
 
 
-async def commands_coro(http_client: http.Client, config: http.Config):
+async def send_device_command_status(http_client: http.Client, semaphore: asyncio.Semaphore,
+                                     command: http.DeviceCommand, status: http.CommandStatus):
+    async with semaphore:
+        await http_client.send_device_command_status(
+            command.device_id,
+            command.command.id,
+            http.CommandStatusMessage(
+                status=status,
+                timestamp=datetime.now(),
+            ),
+        )
+
+
+async def commands_coro(http_client: http.Client):
+    # limits the number of concurrent status requests
+    semaphore = asyncio.Semaphore(16)
+
     while True:
 
         commands = await http_client.get_commands()
 
         print("got commands: ", commands)
 
-        for command in commands.devices:
-            # accepting device command
-            await http_client.send_device_command_status(
-                command.device_id,
-                command.command.id,
+        # accepting device commands
+        await asyncio.gather(*[
+            send_device_command_status(http_client, semaphore, command, http.CommandStatus.received)
+            for command in commands.devices
+        ])
+
+        # do some work ...
+
+        # mark device commands as done
+        await asyncio.gather(*[
+            send_device_command_status(http_client, semaphore, command, http.CommandStatus.done)
+            for command in commands.devices
+        ])
+
+        if commands.command is not None:
+            # accepting agent command
+            await http_client.send_agent_command_status(
+                commands.command.id,
                 http.CommandStatusMessage(
                     status=http.CommandStatus.received,
                     timestamp=datetime.now(),
@@ -27,41 +56,15 @@ async def commands_coro(http_client: http.Client, config: http.Config):
 
             # do some work ...
 
-            # mark device command as done
-            await http_client.send_device_command_status(
-                command.device_id,
-                command.command.id,
+            # mark agent command as done
+            await http_client.send_agent_command_status(
+                commands.command.id,
                 http.CommandStatusMessage(
                     status=http.CommandStatus.done,
                     timestamp=datetime.now(),
                 )
             )
 
-        if commands.command is None:
-            continue
-        
-        # accepting agent command
-        await http_client.send_agent_command_status(
-            config.agent.id,
-            commands.command.id,
-            http.CommandStatusMessage(
-                status=http.CommandStatus.received,
-                timestamp=datetime.now(),
-            ),
-        )
-
-        # do some work ...
-
-        # mark agent command as done
-        await http_client.send_agent_command_status(
-            config.agent.id,
-            commands.command.id,
-            http.CommandStatusMessage(
-                status=http.CommandStatus.done,
-                timestamp=datetime.now(),
-            )
-        )
-
         await asyncio.sleep(10)
 
 
@@ -73,66 +76,72 @@ async def run_example(cli_config):
         agent_token=cli_config.agent_token,
     )
 
-    http_client = http.Client(base_url=cli_config.http_addr, auth=auth)
-
-    # get latest config
-    config = await http_client.get_config()
-    
-    await http_client.send_event(http.EventMessage(
-        tags=[
-            http.EventTag(
-                id=config.agent.tag.children['$state'].children['$status'].id,
-                value="bootstrapping",
-                timestamp=datetime.now()
-            )
-        ]
-    ))
-
-    # bootstrap agent ...
-    scheduler = await aiojobs.create_scheduler()
-    await scheduler.spawn(commands_coro(http_client, config))
-
-    # mark agent is online
-    await http_client.send_event(http.EventMessage(
-        tags=[
-            http.EventTag(
-                id=config.agent.tag.children['$state'].children['$status'].id,
-                value="online",
-                timestamp=datetime.now(),
-            ),
-            http.EventTag(
-                id=config.agent.tag.children['$state'].children['$config'].children['$updated_at'].id,
-                value=datetime.now(),
-                timestamp=datetime.now(),
-            ),
-        ]
-    ))
+    async with http.Client(base_url=cli_config.http_addr, auth=auth) as http_client:
+        # get latest config
+        config = await http_client.get_config()
 
-    # sending temperature from thermometer of first device
-    while True:
-        temp = random.randint(20, 30)
-        print(f"sending temperature value={temp}")
+        # config is immutable, so tag ids can be resolved once
+        agent_tags = config.agent.tag.flat_index()
+        device_tags = config.agent.devices[0].tag.flat_index()
+
+        status_tag_id = agent_tags[('$state', '$status')].id
+        updated_at_tag_id = agent_tags[('$state', '$config', '$updated_at')].id
+        temp_tag_id = device_tags[('thermometer', 'temperature')].id
 
         await http_client.send_event(http.EventMessage(
             tags=[
                 http.EventTag(
-                    id=config.agent.devices[0].tag.children["thermometer"].children["temperature"].id,
-                    value=temp,
-                    timestamp=datetime.now(),
+                    id=status_tag_id,
+                    value="bootstrapping",
+                    timestamp=datetime.now()
                 )
             ]
         ))
 
-        await http_client.send_logs(
-            [
-                http.LogRecord(
-                    level=http.LogLevel.info,
-                    message=f"temperature is {temp}"
+        # bootstrap agent ...
+        async with run_in_background(commands_coro(http_client)):
+            # mark agent is online
+            now = datetime.now()
+            await http_client.send_event(http.EventMessage(
+                tags=[
+                    http.EventTag(
+                        id=status_tag_id,
+                        value="online",
+                        timestamp=now,
+                    ),
+                    http.EventTag(
+                        id=updated_at_tag_id,
+                        value=now,
+                        timestamp=now,
+                    ),
+                ]
+            ))
+
+            # sending temperature from thermometer of first device
+            while True:
+                temp = random.randint(20, 30)
+                print(f"sending temperature value={temp}")
+
+                await http_client.send_event(http.EventMessage(
+                    tags=[
+                        http.EventTag(
+                            id=temp_tag_id,
+                            value=temp,
+                            timestamp=datetime.now(),
+                        )
+                    ]
+                ))
+
+                await http_client.send_logs(
+                    [
+                        http.LogRecord(
+                            level=http.LogLevel.info,
+                            message=f"temperature is {temp}"
+                        )
+                    ]
                 )
-            ]
-        )
 
-        await asyncio.sleep(1)
+                await asyncio.sleep(1)
 
 
 def main():
@@ -143,6 +152,12 @@ def main():
     parser.add_argument("agent_token", type=str, help="Agent Token")
     args = parser.parse_args()
 
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run_example(args))
 
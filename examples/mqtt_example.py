@@ -1,63 +1,120 @@
 import asyncio
-import aiojobs
 import random
 import argparse
 from datetime import datetime
+from typing import Coroutine
 
 import coiiot_client.common as common
 import coiiot_client.http as http
 import coiiot_client.mqtt as mqtt
+from coiiot_client.utils import run_in_background
 
 
-async def commands_coro(mqtt_client: mqtt.Client):
+# queued telemetry is published once BATCH_MAX readings are pending
+# or every BATCH_MS milliseconds
+BATCH_MAX = 32
+BATCH_MS = 5000
+
+# seconds between temperature readings
+SAMPLE_INTERVAL = 1.0
+
+# max number of received command messages waiting to be processed
+COMMANDS_QUEUE_SIZE = 64
+
+# max number of commands handled at the same time
+COMMANDS_CONCURRENCY = 16
+
+
+async def handle_device_command(mqtt_client: mqtt.Client, command: mqtt.DeviceCommand, received_at: datetime):
+    # accepting device command
+    await mqtt_client.send_device_command_status(
+        command.device_id,
+        mqtt.CommandStatusMessage(
+            id=command.command.id,
+            status=common.CommandStatus.received,
+            timestamp=received_at,
+        ),
+        qos=mqtt.QOS_0,
+    )
+
+    # do some work ...
+
+    # mark device command as done
+    await mqtt_client.send_device_command_status(
+        command.device_id,
+        mqtt.CommandStatusMessage(
+            id=command.command.id,
+            status=common.CommandStatus.done,
+            timestamp=datetime.now(),
+        ),
+        qos=mqtt.QOS_1,
+    )
+
+
+async def handle_agent_command(mqtt_client: mqtt.Client, command: mqtt.Command, received_at: datetime):
+    # accepting agent command
+    await mqtt_client.send_agent_command_status(
+        mqtt.CommandStatusMessage(
+            id=command.id,
+            status=common.CommandStatus.received,
+            timestamp=received_at,
+        ),
+        qos=mqtt.QOS_0,
+    )
+
+    # do some work ...
+
+    # mark agent command as done
+    await mqtt_client.send_agent_command_status(
+        mqtt.CommandStatusMessage(
+            id=command.id,
+            status=common.CommandStatus.done,
+            timestamp=datetime.now(),
+        ),
+        qos=mqtt.QOS_1,
+    )
+
+
+async def receive_commands(mqtt_client: mqtt.Client, queue: asyncio.Queue):
     async for commands in mqtt_client.incoming_commands():
+        # all commands of the message are received at the same time
+        await queue.put((commands, datetime.now()))
+
+
+async def commands_coro(mqtt_client: mqtt.Client):
+    # commands are received in a separate task, so incoming messages
+    # are read while statuses of the previous ones are being published
+    queue = asyncio.Queue(maxsize=COMMANDS_QUEUE_SIZE)
+
+    async with run_in_background(receive_commands(mqtt_client, queue)):
+        await process_commands(mqtt_client, queue)
+
+
+async def limited(semaphore: asyncio.Semaphore, coro: Coroutine):
+    async with semaphore:
+        await coro
+
+
+async def process_commands(mqtt_client: mqtt.Client, queue: asyncio.Queue):
+    semaphore = asyncio.Semaphore(COMMANDS_CONCURRENCY)
+
+    while True:
+        commands, received_at = await queue.get()
         print("got commands: ", commands)
 
-        for command in commands.devices:
-            # accepting device command
-            await mqtt_client.send_device_command_status(
-                command.device_id,
-                mqtt.CommandStatusMessage(
-                    id=command.command.id,
-                    status=common.CommandStatus.received,
-                    timestamp=datetime.now(),
-                ),
-            )
-
-            # do some work ...
-
-            # mark device command as done
-            await mqtt_client.send_device_command_status(
-                command.device_id,
-                mqtt.CommandStatusMessage(
-                    id=command.command.id,
-                    status=common.CommandStatus.done,
-                    timestamp=datetime.now(),
-                )
-            )
-
-        if commands.command is None:
-            continue
-        
-        # accepting agent command
-        await mqtt_client.send_agent_command_status(
-            mqtt.CommandStatusMessage(
-                id=commands.command.id,
-                status=common.CommandStatus.received,
-                timestamp=datetime.now(),
-            ),
-        )
-
-        # do some work ...
-
-        # mark agent command as done
-        await mqtt_client.send_agent_command_status(
-            mqtt.CommandStatusMessage(
-                id=commands.command.id,
-                status=common.CommandStatus.done,
-                timestamp=datetime.now(),
-            )
-        )
+        agent_command, device_commands = commands
+
+        # every command is handled in its own task, so slow devices
+        # don't hold up the others
+        handlers = []
+        if agent_command is not None:
+            handlers.append(handle_agent_command(mqtt_client, agent_command, received_at))
+
+        if device_commands:
+            for command in device_commands:
+                handlers.append(handle_device_command(mqtt_client, command, received_at))
+
+        await asyncio.gather(*[limited(semaphore, handler) for handler in handlers])
 
 
 async def run_example(cli_config):
@@ -68,73 +125,104 @@ async def run_example(cli_config):
         agent_token=cli_config.agent_token,
     )
 
-    http_client = http.Client(
+    async with http.Client(
         base_url=cli_config.http_addr,
         auth=auth,
-    )
+        pool_limit=cli_config.http_pool_limit,
+    ) as http_client:
+        # get latest config
+        config = await http_client.get_config()
 
-    # get latest config
-    config = await http_client.get_config()
+    # config is immutable, so tag ids can be resolved once
+    agent_tags = config.agent.tag.flat_index()
+    device_tags = config.agent.devices[0].tag.flat_index()
 
-    mqtt_client = mqtt.Client(broker_uri=cli_config.mqtt_addr, auth=auth)
+    status_tag_id = agent_tags[('$state', '$status')].id
+    updated_at_tag_id = agent_tags[('$state', '$config', '$updated_at')].id
+    temp_tag_id = device_tags[('thermometer', 'temperature')].id
+
+    mqtt_client = mqtt.Client(
+        broker_uri=cli_config.mqtt_addr,
+        auth=auth,
+        batch_size=BATCH_MAX,
+        flush_interval=BATCH_MS / 1000,
+    )
 
     await mqtt_client.run()
-    
-    await mqtt_client.send_event(mqtt.EventMessage(
-        tags=[
-            mqtt.EventTag(
-                id=config.agent.tag.children['$state'].children['$status'].id,
-                value="bootstrapping",
-                timestamp=datetime.now()
-            )
-        ]
-    ))
-
-    # bootstrap agent ...
-    scheduler = await aiojobs.create_scheduler()
-    await scheduler.spawn(commands_coro(mqtt_client))
-
-    # mark agent is online
-    await mqtt_client.send_event(mqtt.EventMessage(
-        tags=[
-            mqtt.EventTag(
-                id=config.agent.tag.children['$state'].children['$status'].id,
-                value="online",
-                timestamp=datetime.now(),
-            ),
-            mqtt.EventTag(
-                id=config.agent.tag.children['$state'].children['$config'].children['$updated_at'].id,
-                value=datetime.now(),
-                timestamp=datetime.now(),
-            ),
-        ]
-    ))
-
-    # sending temperature from thermometer of first device
-    while True:
-        temp = random.randint(20, 30)
-        print(f"sending temperature value={temp}")
 
+    try:
         await mqtt_client.send_event(mqtt.EventMessage(
             tags=[
                 mqtt.EventTag(
-                    id=config.agent.devices[0].tag.children["thermometer"].children["temperature"].id,
-                    value=temp,
-                    timestamp=datetime.now(),
+                    id=status_tag_id,
+                    value="bootstrapping",
+                    timestamp=datetime.now()
                 )
             ]
         ))
 
-        await mqtt_client.send_logs(
-            [
-                mqtt.LogRecord(
-                    level=mqtt.LogLevel.info,
-                    message=f"temperature is {temp}"
+        # bootstrap agent ...
+        async with run_in_background(commands_coro(mqtt_client)):
+            # mark agent is online
+            now = datetime.now()
+            await mqtt_client.send_event(mqtt.EventMessage(
+                tags=[
+                    mqtt.EventTag(
+                        id=status_tag_id,
+                        value="online",
+                        timestamp=now,
+                    ),
+                    mqtt.EventTag(
+                        id=updated_at_tag_id,
+                        value=now,
+                        timestamp=now,
+                    ),
+                ]
+            ))
+
+            # sending temperature from thermometer of first device,
+            # the client publishes queued readings in batches
+            loop = asyncio.get_event_loop()
+            deadline = loop.time()
+
+            while True:
+                temp = random.randint(20, 30)
+
+                mqtt_client.send_event_nowait(
+                    mqtt.EventTag(
+                        id=temp_tag_id,
+                        value=temp,
+                        timestamp=datetime.now(),
+                    )
                 )
-            ]
-        )
 
-        await asyncio.sleep(1)
+                mqtt_client.send_log_nowait(
+                    mqtt.LogRecord(
+                        level=mqtt.LogLevel.info,
+                        message=f"temperature is {temp}"
+                    )
+                )
+
+                # sleeping until the next tick instead of a fixed second keeps
+                # sampling at SAMPLE_INTERVAL regardless of publish latency
+                deadline += SAMPLE_INTERVAL
+                delay = deadline - loop.time()
+                if delay < -SAMPLE_INTERVAL:
+                    # more than a tick behind, skip the missed ticks
+                    mqtt_client.send_log_nowait(
+                        mqtt.LogRecord(
+                            level=mqtt.LogLevel.warn,
+                            message=f"sensor loop is {-delay:.1f}s behind schedule, skipping missed readings",
+                        )
+                    )
+                    deadline = loop.time()
+                    delay = 0.0
+
+                await asyncio.sleep(max(0.0, delay))
+
+    finally:
+        # publishes the queued readings and disconnects
+        await mqtt_client.close()
 
 
 def main():
@@ -144,8 +232,15 @@ def main():
     parser.add_argument("client_id", type=int, help="Client ID")
     parser.add_argument("agent_id", type=int, help="Agent ID")
     parser.add_argument("agent_token", type=str, help="Agent Token")
+    parser.add_argument("--http-pool-limit", type=int, default=10, help="Max number of HTTP connections")
     args = parser.parse_args()
 
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run_example(args))
 
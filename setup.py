@@ -7,11 +7,18 @@ setup(
     packages=find_packages(include="coiiot_client.*"),
 
     install_requires=[
-        'aiohttp==3.4.4',
-        'hbmqtt==0.9.6',
-        'simplejson==3.17.6',
+        'aiohttp>=3.8',
+        'aiomqtt>=2.0',
+        'orjson>=3.9',
     ],
 
+    extras_require={
+        'fast': [
+            'uvloop>=0.19; platform_system != "Windows"',
+            'pysimdjson>=5.0',
+        ],
+    },
+
     package_data={},
 
     # metadata to display on PyPI
@@ -1,50 +1,19 @@
+from typing import AsyncContextManager
 from unittest.mock import patch
+from contextlib import asynccontextmanager
 from datetime import datetime
+import asyncio
+import json
 
 import pytest
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 import coiiot_client.http as http
-import coiiot_client.utils as utils
 
 
-class MockResponse:
-    def __init__(self, text, status):
-        self._text = text
-        self.status = status
-
-    async def text(self):
-        return self._text
-
-    async def __aexit__(self, exc_type, exc, tb):
-        pass
-
-    async def __aenter__(self):
-        return self
-
-
-@pytest.mark.asyncio
-async def test_should_catch_http_error(event_loop):
-    with patch('aiohttp.ClientSession.get') as mock:
-
-        mock.return_value = MockResponse("", 404)
-
-        auth = http.Auth(1, 10, "")
-        client = http.Client("", auth, loop=event_loop)
-
-        not_found_raised = False
-        try:
-            await client.get_commands()
-        except http.NotFoundError:
-            not_found_raised = True
-
-        assert not_found_raised
-
-
-@pytest.mark.asyncio
-async def test_get_config(event_loop):
-    with patch('aiohttp.ClientSession.get') as mock:
-
-        resp = r"""
+CONFIG_RESP = b"""
 {
     "agent":{
         "config_id":1,
@@ -96,13 +65,276 @@ async def test_get_config(event_loop):
 }
         """
 
+UNCHANGED_CONFIG_RESP = b"""
+{
+    "agent":{
+        "devices":[],
+        "id":1,
+        "name":"some_agent",
+        "tag":{
+            "id":1,
+            "name":"some_tag",
+            "properties":{},
+            "type":{
+                "id":1,
+                "name":"undefined"
+            }
+        }
+    },
+    "version":"v1"
+}
+        """
+
+COMMANDS_RESP = b"""
+{
+  "command": {
+    "created_at": 1577826000000000,
+    "id": "some-id",
+    "reason": "Failed to send command",
+    "status": "new",
+    "tags": [
+      {
+        "tag_id": 1,
+        "value": true
+      }
+    ],
+    "updated_at": 1577826000000000
+  },
+  "devices": [
+    {
+      "command": {
+        "created_at": 1577826000000000,
+        "id": "some-id",
+        "reason": "Failed to send command",
+        "status": "new",
+        "tags": [
+          {
+            "tag_id": 1,
+            "value": true
+          }
+        ],
+        "updated_at": 1577826000000000
+      },
+      "device_id": 1
+    }
+  ]
+}
+        """
+
+VERSIONED_CONFIG_RESP = b"""
+{
+  "created_at": 1577826000000000,
+  "device_config": {"key": "value"},
+  "device_id": 1,
+  "id": 1
+}
+        """
+
+
+def respond(body: bytes = b"", status: int = 200, requests: list = None):
+    async def handler(request: web.Request) -> web.Response:
+        if requests is not None:
+            requests.append(await request.read())
+
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    return handler
+
+
+@asynccontextmanager
+async def serve(*routes: web.RouteDef) -> AsyncContextManager[str]:
+    app = web.Application()
+    app.router.add_routes(routes)
+
+    server = TestServer(app)
+    await server.start_server()
+
+    try:
+        yield str(server.make_url("")).rstrip("/")
+
+    finally:
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_should_catch_http_error(event_loop):
+    async with serve(web.get("/v1/commands", respond(status=404))) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            not_found_raised = False
+            try:
+                await client.get_commands()
+            except http.NotFoundError:
+                not_found_raised = True
+
+        assert not_found_raised
+
+
+@pytest.mark.asyncio
+async def test_send_event_does_not_read_body(event_loop):
+    requests = []
+    async with serve(web.post("/v1/events", respond(requests=requests))) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            with patch.object(aiohttp.ClientResponse, "read") as read:
+                await client.send_event(http.EventMessage(
+                    tags=[
+                        http.EventTag(
+                            id=1,
+                            value=1,
+                            timestamp=datetime.fromtimestamp(1e8),
+                        )
+                    ]
+                ))
+
+        assert len(requests) == 1
+        assert not read.called
+
 
-        mock.return_value = MockResponse(resp, 200)
+@pytest.mark.asyncio
+async def test_send_event_reuses_connection(event_loop):
+    peers = []
+
+    async def handler(request: web.Request) -> web.Response:
+        peers.append(request.transport.get_extra_info("peername"))
+        # a body bigger than the socket buffer is not received with the headers
+        return web.Response(body=b"x" * (4 * 1024 * 1024))
+
+    async with serve(web.post("/v1/events", handler)) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            for i in range(3):
+                await client.send_event(http.EventMessage(
+                    tags=[
+                        http.EventTag(
+                            id=i,
+                            value=i,
+                            timestamp=datetime.fromtimestamp(1e8),
+                        )
+                    ]
+                ))
+
+        assert len(peers) == 3
+        assert len(set(peers)) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_event_nowait_batches_tags(event_loop):
+    requests = []
+    async with serve(web.post("/v1/events", respond(requests=requests))) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        client = http.Client(base_url, auth, loop=event_loop, flush_interval=60)
+
+        for i in range(3):
+            client.send_event_nowait(
+                http.EventTag(
+                    id=i,
+                    value=i,
+                    timestamp=datetime.fromtimestamp(1e8),
+                )
+            )
+
+        assert not requests
+
+        await client.close()
+
+        assert len(requests) == 1
+        assert [tag["id"] for tag in json.loads(requests[0])["tags"]] == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_close_sends_in_flight_batch(event_loop):
+    requests = []
+    async with serve(web.post("/v1/events", respond(requests=requests))) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop, batch_size=3) as client:
+            send_event = client.send_event
+
+            async def slow_send_event(msg):
+                await asyncio.sleep(0.1)
+                await send_event(msg)
+
+            with patch.object(client, "send_event", slow_send_event):
+                for i in range(5):
+                    client.send_event_nowait(
+                        http.EventTag(
+                            id=i,
+                            value=i,
+                            timestamp=datetime.fromtimestamp(1e8),
+                        )
+                    )
+
+                # the flush task is sending the first batch now
+                await asyncio.sleep(0.05)
+                await client.close()
+
+        assert [tag["id"] for body in requests for tag in json.loads(body)["tags"]] == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_failed_background_flush_is_retried(event_loop):
+    statuses = [500]
+    requests = []
+
+    async def handler(request: web.Request) -> web.Response:
+        status = statuses.pop(0) if statuses else 200
+        if status == 200:
+            requests.append(await request.read())
+
+        return web.Response(status=status)
+
+    def make_tag(i):
+        return http.EventTag(id=i, value=i, timestamp=datetime.fromtimestamp(1e8))
+
+    async with serve(web.post("/v1/events", handler)) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop, flush_interval=0.05) as client:
+            client.send_event_nowait(make_tag(1))
+            await asyncio.sleep(0.2)
+
+            # the error is raised once and the tag of the failed call is not taken
+            with pytest.raises(http.InternalServerError):
+                client.send_event_nowait(make_tag(2))
+
+            client.send_event_nowait(make_tag(2))
+            await client.flush()
+
+        assert [tag["id"] for body in requests for tag in json.loads(body)["tags"]] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_send_agent_command_status_omits_unset_fields(event_loop):
+    requests = []
+    route = web.patch("/v1/agents/10/commands/some-id/status", respond(requests=requests))
+    async with serve(route) as base_url:
 
         auth = http.Auth(1, 10, "")
-        client = http.Client("", auth, loop=event_loop)
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            await client.send_agent_command_status(
+                "some-id",
+                http.CommandStatusMessage(
+                    status=http.CommandStatus.done,
+                    timestamp=None,
+                    reason=None,
+                ),
+            )
+
+        assert [json.loads(body) for body in requests] == [{"status": "done"}]
 
-        config = await client.get_config()
+
+@pytest.mark.asyncio
+async def test_get_config(event_loop):
+    async with serve(web.get("/v1/agents/config", respond(CONFIG_RESP))) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            config = await client.get_config()
 
         tag = http.Tag(
             id=1,
@@ -151,52 +383,100 @@ async def test_get_config(event_loop):
 
 
 @pytest.mark.asyncio
-async def test_get_commands(event_loop):
-    with patch('aiohttp.ClientSession.get') as mock:
+async def test_get_config_reuses_unchanged_config(event_loop):
+    responses = [
+        UNCHANGED_CONFIG_RESP,
+        UNCHANGED_CONFIG_RESP,
+        UNCHANGED_CONFIG_RESP.replace(b'"v1"', b'"v2"'),
+    ]
 
-        resp = r"""
-{
-  "command": {
-    "created_at": 1577826000000000,
-    "id": "some-id",
-    "reason": "Failed to send command",
-    "status": "new",
-    "tags": [
-      {
-        "tag_id": 1,
-        "value": true
-      }
-    ],
-    "updated_at": 1577826000000000
-  },
-  "devices": [
-    {
-      "command": {
-        "created_at": 1577826000000000,
-        "id": "some-id",
-        "reason": "Failed to send command",
-        "status": "new",
-        "tags": [
-          {
-            "tag_id": 1,
-            "value": true
-          }
-        ],
-        "updated_at": 1577826000000000
-      },
-      "device_id": 1
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(body=responses.pop(0), content_type="application/json")
+
+    async with serve(web.get("/v1/agents/config", handler)) as base_url:
+
+        auth = http.Auth(1, 10, "")
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            first = await client.get_config()
+            second = await client.get_config()
+
+            assert len(responses) == 1
+            assert first is second
+
+            third = await client.get_config()
+
+        assert third.version == "v2"
+        assert third.agent == first.agent
+
+
+@pytest.mark.parametrize("path", [
+    ("agent", "tag"),
+    ("agent", "devices", 0, "tag"),
+    ("agent", "devices", 0, "driver"),
+    ("agent", "tag", "properties"),
+])
+def test_config_rejects_null_required_field(path):
+    raw = json.loads(CONFIG_RESP)
+    parent = raw
+    for key in path[:-1]:
+        parent = parent[key]
+    parent[path[-1]] = None
+
+    with pytest.raises(http.ImproperlyConfigurationError, match=f'"{path[-1]}"'):
+        http.Config.loads(json.dumps(raw), http.ImproperlyConfigurationError)
+
+
+@pytest.mark.parametrize("path", [
+    ("agent", "tag", "name"),
+    ("agent", "tag", "type", "name"),
+])
+@pytest.mark.parametrize("value", [None, 1])
+def test_config_rejects_invalid_tag_name(path, value):
+    raw = json.loads(CONFIG_RESP)
+    parent = raw
+    for key in path[:-1]:
+        parent = parent[key]
+    parent[path[-1]] = value
+
+    with pytest.raises(http.ImproperlyConfigurationError, match='"name"'):
+        http.Config.loads(json.dumps(raw), http.ImproperlyConfigurationError)
+
+
+def test_tag_flat_index():
+    tag_type = http.TagType(id=1, name="undefined")
+
+    def make_tag(id, name, children):
+        return http.Tag(
+            id=id,
+            name=name,
+            type=tag_type,
+            properties={},
+            attrs={},
+            children={child.name: child for child in children},
+            driver_config={},
+        )
+
+    status = make_tag(3, "$status", [])
+    state = make_tag(2, "$state", [status])
+    root = make_tag(1, "root", [state])
+
+    index = root.flat_index()
+
+    assert index == {
+        (): root,
+        ("$state",): state,
+        ("$state", "$status"): status,
     }
-  ]
-}
-        """
+    assert index[("$state", "$status")] is status
 
 
-        mock.return_value = MockResponse(resp, 200)
+@pytest.mark.asyncio
+async def test_get_commands(event_loop):
+    async with serve(web.get("/v1/commands", respond(COMMANDS_RESP))) as base_url:
 
         auth = http.Auth(1, 10, "")
-        client = http.Client("", auth, loop=event_loop)
-
-        commands = await client.get_commands()
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            commands = await client.get_commands()
 
         cmd = http.CommandExtended(
             id="some-id",
@@ -225,24 +505,11 @@ async def test_get_commands(event_loop):
 
 @pytest.mark.asyncio
 async def test_get_device_versioned_config(event_loop):
-    with patch('aiohttp.ClientSession.get') as mock:
-
-        resp = r"""
-{
-  "created_at": 1577826000000000,
-  "device_config": {"key": "value"},
-  "device_id": 1,
-  "id": 1
-}
-        """
-
-
-        mock.return_value = MockResponse(resp, 200)
+    async with serve(web.get("/v1/devices/config/10", respond(VERSIONED_CONFIG_RESP))) as base_url:
 
         auth = http.Auth(1, 10, "")
-        client = http.Client("", auth, loop=event_loop)
-
-        config = await client.get_device_versioned_config(10)
+        async with http.Client(base_url, auth, loop=event_loop) as client:
+            config = await client.get_device_versioned_config(10)
 
         assert config == http.VersionedDeviceConfig(
             created_at=datetime(2020, 1, 1),
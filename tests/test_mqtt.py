@@ -1,61 +1,68 @@
 from typing import AsyncContextManager
 from datetime import datetime
 from contextlib import asynccontextmanager
+from unittest.mock import patch
 import asyncio
 
 import pytest
+import pytest_asyncio
 
-import simplejson as json
-from hbmqtt.client import MQTTClient as TestClient, QOS_1
+import orjson
+import aiomqtt
 
 import coiiot_client.mqtt as mqtt
 
 
-@asynccontextmanager
-async def create_test_client(loop, topic=None) -> AsyncContextManager[TestClient]:
-    test_client = TestClient("tester", loop=loop)
-    await test_client.connect(uri="mqtt://localhost:1883")
-    if topic is not None:
-        await test_client.subscribe([(topic, QOS_1)])
+QOS_1 = 1
 
-    try:
+AGENT_ID = 1
+
+
+@pytest.fixture(scope="module")
+def event_loop():
+    # the broker connection is shared by the whole module, and so is the loop
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="module")
+async def broker() -> aiomqtt.Client:
+    async with aiomqtt.Client("localhost", 1883, identifier="tester") as test_client:
         yield test_client
 
+
+@pytest_asyncio.fixture
+async def client() -> mqtt.Client:
+    client = mqtt.Client(
+        broker_uri="localhost:1883",
+        auth=mqtt.Auth(client_id=100, agent_id=AGENT_ID, agent_token="tok"),
+    )
+
+    await client.run()
+
+    try:
+        yield client
+
     finally:
-        await test_client.disconnect()
+        await client.close()
 
 
-@pytest.mark.asyncio
-async def test_send_event(event_loop):
-    topic = "iot/event/fmt/json"
-    async with create_test_client(topic=topic, loop=event_loop) as test_client:
-        agent = mqtt.Agent(
-            id=1,
-            config_id=1,
-            name="test_agent",
-            tag=mqtt.Tag(
-                id=1,
-                name="test_tag",
-                type=mqtt.TagType(
-                    id=1,
-                    name="test_type",
-                ),
-                children={},
-                properties={},
-                driver_config={},
-                attrs={},
-            ),
-            devices=[],
-        )
+@asynccontextmanager
+async def subscription(broker: aiomqtt.Client, topic: str) -> AsyncContextManager[aiomqtt.Client]:
+    await broker.subscribe(topic, qos=QOS_1)
 
-        client = mqtt.Client(
-            broker_uri="localhost:1883",
-            auth=mqtt.Auth(client_id=100, agent_id=agent.id, agent_token="tok"),
-            loop=event_loop,
-        )
+    try:
+        yield broker
+
+    finally:
+        await broker.unsubscribe(topic)
 
-        await client.run()
 
+@pytest.mark.asyncio
+async def test_send_event(broker, client):
+    topic = "iot/event/fmt/json"
+    async with subscription(broker, topic):
         await client.send_event(
             mqtt.EventMessage(
                 tags=[
@@ -68,9 +75,9 @@ async def test_send_event(event_loop):
             )
         )
 
-        message = await asyncio.wait_for(test_client.deliver_message(), 5)
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
 
-        assert json.loads(message.data.decode("utf8")) == {
+        assert orjson.loads(message.payload) == {
             "tags": [
                 {
                     "id": 1,
@@ -80,41 +87,204 @@ async def test_send_event(event_loop):
             ]
         }
 
-        await client.close()
+
+@pytest.mark.asyncio
+async def test_send_event_nowait_batches_tags(broker, client):
+    topic = "iot/event/fmt/json"
+    async with subscription(broker, topic):
+        for tag_id in range(3):
+            client.send_event_nowait(
+                mqtt.EventTag(
+                    id=tag_id,
+                    value=tag_id,
+                    timestamp=datetime.fromtimestamp(1e8)
+                )
+            )
+
+        await client.flush()
+
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
+
+        assert orjson.loads(message.payload) == {
+            "tags": [
+                {
+                    "id": tag_id,
+                    "value": tag_id,
+                    "timestamp": 1e8 * 1e6
+                }
+                for tag_id in range(3)
+            ]
+        }
+
+
+@pytest.mark.asyncio
+async def test_close_publishes_in_flight_batch(broker):
+    client = mqtt.Client(
+        broker_uri="localhost:1883",
+        auth=mqtt.Auth(client_id=100, agent_id=AGENT_ID, agent_token="tok"),
+        batch_size=3,
+    )
+    await client.run()
+
+    publish = client._client.publish
+
+    async def slow_publish(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        await publish(*args, **kwargs)
+
+    topic = "iot/event/fmt/json"
+    async with subscription(broker, topic):
+        with patch.object(client._client, "publish", slow_publish):
+            for tag_id in range(4):
+                client.send_event_nowait(
+                    mqtt.EventTag(
+                        id=tag_id,
+                        value=tag_id,
+                        timestamp=datetime.fromtimestamp(1e8)
+                    )
+                )
+
+            # the flusher is publishing the first batch now
+            await asyncio.sleep(0.05)
+            await client.close()
+
+        tag_ids = []
+        for _ in range(2):
+            message = await asyncio.wait_for(broker.messages.__anext__(), 5)
+            tag_ids.extend(tag["id"] for tag in orjson.loads(message.payload)["tags"])
+
+        assert tag_ids == [0, 1, 2, 3]
 
 
 @pytest.mark.asyncio
-async def test_send_agent_command_status(event_loop):
-    agent_id = 1
-    topic = f"iot/cmd/agent/{agent_id}/status/fmt/json"
-    async with create_test_client(topic=topic, loop=event_loop) as test_client:
-        agent = mqtt.Agent(
-            id=agent_id,
-            config_id=1,
-            name="test_agent",
-            tag=mqtt.Tag(
+async def test_failed_background_publish_is_retried(broker, client):
+    async def broken_publish(*args, **kwargs):
+        raise aiomqtt.MqttError("broken")
+
+    def make_tag(tag_id):
+        return mqtt.EventTag(id=tag_id, value=tag_id, timestamp=datetime.fromtimestamp(1e8))
+
+    topic = "iot/event/fmt/json"
+    async with subscription(broker, topic):
+        with patch.object(client._client, "publish", broken_publish):
+            client.send_event_nowait(make_tag(1))
+            await asyncio.sleep(client._flush_interval * 2)
+
+        # the error is raised once and the tag of the failed call is not taken
+        with pytest.raises(aiomqtt.MqttError):
+            client.send_event_nowait(make_tag(2))
+
+        client.send_event_nowait(make_tag(2))
+        await client.flush()
+
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
+
+        assert [tag["id"] for tag in orjson.loads(message.payload)["tags"]] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_client_not_running():
+    client = mqtt.Client(
+        broker_uri="localhost:1883",
+        auth=mqtt.Auth(client_id=100, agent_id=AGENT_ID, agent_token="tok"),
+    )
+
+    with pytest.raises(mqtt.ClientNotRunningError):
+        client.send_event_nowait(mqtt.EventTag(id=1, value=1, timestamp=datetime.fromtimestamp(1e8)))
+
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_subscription_closes_connection():
+    client = mqtt.Client(
+        broker_uri="localhost:1883",
+        auth=mqtt.Auth(client_id=100, agent_id=AGENT_ID, agent_token="tok"),
+    )
+
+    async def rejected_subscribe(*args, **kwargs):
+        return [0x80]
+
+    aexit = aiomqtt.Client.__aexit__
+    with patch.object(aiomqtt.Client, "subscribe", rejected_subscribe), \
+            patch.object(aiomqtt.Client, "__aexit__", autospec=True, side_effect=aexit) as exit_mock:
+        with pytest.raises(mqtt.SubscriptionError):
+            await client.run()
+
+    assert exit_mock.call_count == 1
+
+    with pytest.raises(mqtt.ClientNotRunningError):
+        await client.flush()
+
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_flush_interleaves_statuses_with_events(broker, client):
+    status_topic = f"iot/cmd/agent/{AGENT_ID}/status/fmt/json"
+    event_topic = "iot/event/fmt/json"
+    async with subscription(broker, status_topic), subscription(broker, event_topic):
+        client.send_event_nowait(
+            mqtt.EventTag(
                 id=1,
-                name="test_tag",
-                type=mqtt.TagType(
-                    id=1,
-                    name="test_type",
-                ),
-                children={},
-                properties={},
-                driver_config={},
-                attrs={},
-            ),
-            devices=[],
+                value=1,
+                timestamp=datetime.fromtimestamp(1e8)
+            )
         )
 
-        client = mqtt.Client(
-            broker_uri="localhost:1883",
-            auth=mqtt.Auth(client_id=100, agent_id=agent.id, agent_token="tok"),
-            loop=event_loop,
+        for i in range(mqtt.STATUS_WEIGHT + 1):
+            client.send_agent_command_status_nowait(
+                mqtt.CommandStatusMessage(
+                    id=f"command_{i}",
+                    status=mqtt.CommandStatus.done,
+                    timestamp=datetime.fromtimestamp(1e8),
+                )
+            )
+
+        await client.flush()
+
+        topics = []
+        for _ in range(mqtt.STATUS_WEIGHT + 2):
+            message = await asyncio.wait_for(broker.messages.__anext__(), 5)
+            topics.append(message.topic.value)
+
+        assert topics == [status_topic] * mqtt.STATUS_WEIGHT + [event_topic, status_topic]
+
+
+@pytest.mark.asyncio
+async def test_flush_publishes_only_items_queued_before_it(client):
+    def queue_status():
+        client.send_agent_command_status_nowait(
+            mqtt.CommandStatusMessage(
+                id="some_command",
+                status=mqtt.CommandStatus.done,
+                timestamp=datetime.fromtimestamp(1e8),
+            )
         )
 
-        await client.run()
+    publish = client._client.publish
+    published = 0
+
+    async def publish_and_queue(*args, **kwargs):
+        nonlocal published
+        published += 1
+        # a producer queueing a new status for every published one
+        queue_status()
+        await publish(*args, **kwargs)
+
+    queue_status()
+    queue_status()
 
+    with patch.object(client._client, "publish", publish_and_queue):
+        # awaited directly, so it takes the flush lock before the woken flusher
+        await client.flush()
+        assert published == 2
+
+
+@pytest.mark.asyncio
+async def test_send_agent_command_status(broker, client):
+    topic = f"iot/cmd/agent/{AGENT_ID}/status/fmt/json"
+    async with subscription(broker, topic):
         await client.send_agent_command_status(
             mqtt.CommandStatusMessage(
                 id="some_command",
@@ -124,74 +294,21 @@ async def test_send_agent_command_status(event_loop):
             )
         )
 
-        message = await asyncio.wait_for(test_client.deliver_message(), 5)
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
 
-        assert json.loads(message.data.decode("utf8")) == {
+        assert orjson.loads(message.payload) == {
             "id": "some_command",
             "status": "done",
             "reason": None,
             "timestamp": 1e8 * 1e6,
         }
 
-        await client.close()
-
 
 @pytest.mark.asyncio
-async def test_send_device_command_status(event_loop):
+async def test_send_device_command_status(broker, client):
     device_id = 100
     topic = f"iot/cmd/device/{device_id}/status/fmt/json"
-    async with create_test_client(topic=topic, loop=event_loop) as test_client:
-        agent = mqtt.Agent(
-            id=1,
-            config_id=1,
-            name="test_agent",
-            tag=mqtt.Tag(
-                id=1,
-                name="test_tag",
-                type=mqtt.TagType(
-                    id=1,
-                    name="test_type",
-                ),
-                children={},
-                properties={},
-                driver_config={},
-                attrs={},
-            ),
-            devices=[
-                mqtt.Device(
-                    id=device_id,
-                    config_id=1,
-                    name="test_device",
-                    tag=mqtt.Tag(
-                        id=2,
-                        name="event_tag",
-                        type=mqtt.TagType(
-                            id=1,
-                            name="event",
-                        ),
-                        children={},
-                        properties={},
-                        driver_config={},
-                        attrs={},
-                    ),
-                    driver_config={},
-                    driver=mqtt.Driver(
-                        id=3,
-                        name="test_driver",
-                        protocol="mqtt",
-                    )
-                )
-            ],
-        )
-
-        client = mqtt.Client(
-            broker_uri="localhost:1883",
-            auth=mqtt.Auth(client_id=100, agent_id=agent.id, agent_token="tok"),
-            loop=event_loop,
-        )
-
-        await client.run()
-
+    async with subscription(broker, topic):
         await client.send_device_command_status(
             device_id,
             mqtt.CommandStatusMessage(
@@ -202,49 +319,20 @@ async def test_send_device_command_status(event_loop):
             )
         )
 
-        message = await asyncio.wait_for(test_client.deliver_message(), 5)
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
 
-        assert json.loads(message.data.decode("utf8")) == {
+        assert orjson.loads(message.payload) == {
             "id": "some_command",
             "status": "done",
             "reason": None,
             "timestamp": 1e8 * 1e6,
         }
 
-        await client.close()
-
 
 @pytest.mark.asyncio
-async def test_send_logs(event_loop):
+async def test_send_logs(broker, client):
     topic = "iot/log/fmt/json"
-    async with create_test_client(topic=topic, loop=event_loop) as test_client:
-        agent = mqtt.Agent(
-            id=1,
-            config_id=1,
-            name="test_agent",
-            tag=mqtt.Tag(
-                id=1,
-                name="test_tag",
-                type=mqtt.TagType(
-                    id=1,
-                    name="test_type",
-                ),
-                children={},
-                properties={},
-                driver_config={},
-                attrs={},
-            ),
-            devices=[],
-        )
-
-        client = mqtt.Client(
-            broker_uri="localhost:1883",
-            auth=mqtt.Auth(client_id=100, agent_id=agent.id, agent_token="tok"),
-            loop=event_loop,
-        )
-
-        await client.run()
-
+    async with subscription(broker, topic):
         await client.send_logs(
             [
                 mqtt.LogRecord(
@@ -258,9 +346,9 @@ async def test_send_logs(event_loop):
             ]
         )
 
-        message = await asyncio.wait_for(test_client.deliver_message(), 5)
+        message = await asyncio.wait_for(broker.messages.__anext__(), 5)
 
-        assert json.loads(message.data.decode("utf8")) == [
+        assert orjson.loads(message.payload) == [
             {
                 "level": 1,
                 "message": "first",
@@ -271,71 +359,77 @@ async def test_send_logs(event_loop):
             },
         ]
 
-        await client.close()
-
 
 @pytest.mark.asyncio
-async def test_receive_incoming_commands(event_loop):
-    async with create_test_client(loop=event_loop) as test_client:
-        agent = mqtt.Agent(
-            id=1,
-            config_id=1,
-            name="test_agent",
-            tag=mqtt.Tag(
-                id=1,
-                name="test_tag",
-                type=mqtt.TagType(
+async def test_receive_incoming_commands(broker, client):
+    await broker.publish(
+        f"iot/cmd/agent/{AGENT_ID}/fmt/json",
+        orjson.dumps({
+            "command": {
+                "id": "some_command",
+                "tags": [
+                    {
+                        "id": 1,
+                        "value": True,
+                    }
+                ],
+                "timestamp": 1577826000000000,
+            },
+            "devices": [],
+        }),
+        qos=QOS_1
+    )
+
+    cmd = await asyncio.wait_for(client.incoming_commands().__anext__(), 5)
+
+    assert cmd == mqtt.CommandMessage(
+        command = mqtt.Command(
+            id="some_command",
+            tags=[
+                mqtt.CommandTag(
                     id=1,
-                    name="test_type",
-                ),
-                children={},
-                properties={},
-                driver_config={},
-                attrs={},
-            ),
-            devices=[],
-        )
+                    value=True,
+                )
+            ],
+            timestamp=datetime(2020, 1, 1),
+        ),
+        devices = [],
+    )
+
+
+def test_event_message_dumps_mixed_timestamps():
+    shared = datetime.fromtimestamp(1e8)
+    msg = mqtt.EventMessage(
+        tags=[
+            mqtt.EventTag(id=1, value=1, timestamp=shared),
+            mqtt.EventTag(id=2, value=2, timestamp=shared),
+            mqtt.EventTag(id=3, value=3, timestamp=datetime.fromtimestamp(2e8)),
+            mqtt.EventTag(id=4, value=4, timestamp=shared),
+        ]
+    )
 
-        client = mqtt.Client(
-            broker_uri="localhost:1883",
-            auth=mqtt.Auth(client_id=100, agent_id=agent.id, agent_token="tok"),
-            loop=event_loop,
-        )
+    assert [tag["timestamp"] for tag in orjson.loads(msg.dumps())["tags"]] == [
+        1e8 * 1e6, 1e8 * 1e6, 2e8 * 1e6, 1e8 * 1e6,
+    ]
 
-        await client.run()
-
-        await test_client.publish(
-            f"iot/cmd/agent/{agent.id}/fmt/json",
-            json.dumps({
-                "command": {
-                    "id": "some_command",
-                    "tags": [
-                        {
-                            "id": 1,
-                            "value": True,
-                        }
-                    ],
-                    "timestamp": 1577826000000000,
-                },
-                "devices": [],
-            }).encode("utf8"),
-            qos=QOS_1
-        )
 
-        cmd = await asyncio.wait_for(client.incoming_commands().__anext__(), 5)
+class _Timestamp(datetime):
+    pass
 
-        assert cmd == mqtt.CommandMessage(
-            command = mqtt.Command(
-                id="some_command",
-                tags=[
-                    mqtt.CommandTag(
-                        id=1,
-                        value=True,
-                    )
-                ],
-                timestamp=datetime(2020, 1, 1),
-            ),
-            devices = [],
-        )
 
-        await client.close()
+class _Location(mqtt.Location):
+    pass
+
+
+@pytest.mark.parametrize("value, expected", [
+    (_Timestamp.fromtimestamp(1e8), 1e8 * 1e6),
+    (_Location(lat=1.0, lng=2.0), {"lat": 1.0, "lng": 2.0}),
+    (True, True),
+    ("text", "text"),
+])
+def test_event_message_dumps_value_subclasses(value, expected):
+    tag = mqtt.EventTag(id=1, value=value, timestamp=datetime.fromtimestamp(1e8))
+    msg = mqtt.EventMessage(tags=[tag])
+
+    assert orjson.loads(msg.dumps())["tags"] == [orjson.loads(orjson.dumps(tag.to_dict()))]
+    assert orjson.loads(msg.dumps())["tags"][0]["value"] == expected
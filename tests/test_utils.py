@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+import coiiot_client.utils as utils
+
+
+@pytest.mark.asyncio
+async def test_run_in_background_cancels_task_on_exit():
+    async with utils.run_in_background(asyncio.sleep(3600)) as task:
+        await asyncio.sleep(0)
+
+    assert task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_run_in_background_reports_task_error(event_loop):
+    errors = []
+    event_loop.set_exception_handler(lambda loop, context: errors.append(context["exception"]))
+
+    async def fail():
+        raise ValueError("broken")
+
+    async with utils.run_in_background(fail()) as task:
+        await asyncio.sleep(0.01)
+        # the block keeps running after the task failed
+        assert task.done()
+
+    assert [type(error) for error in errors] == [ValueError]